@@ -12,25 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import datetime
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import SuspiciousOperation
+from django.db import transaction
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.settings import import_from_string
-from rest_framework.authentication import get_authorization_header
 
-from django.utils.encoding import force_bytes, smart_text, smart_bytes
-from django.utils.translation import ugettext as _
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.translation import gettext as _
 from mozilla_django_oidc.auth import OIDCAuthenticationBackend
 
 from bossoidc2.models import Keycloak as KeycloakModel
-from jwkest.jwt import JWT
-from josepy.jws import JWS, Header
+from josepy.b64 import b64decode
+from josepy.jws import Header
+# NOTE: jwkest is imported when first used, so that loading this module doesn't
+#       pay for importing it
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import functools
+import hashlib
 import json
 import logging
+import threading
+import time
 
 def _log(child):
     return logging.getLogger(__name__).getChild(child)
@@ -54,6 +62,108 @@ else: # pragma: no cover
 
 KEYCLOAK_ADMIN_USER = getattr(settings, 'KEYCLOAK_ADMIN_USER', 'bossadmin')
 
+# Don't assume that the bossoidc settings module was used
+if hasattr(settings, 'OIDC_AUTH'):
+    _TRUSTED_AUDIENCES = frozenset(settings.OIDC_AUTH.get('OIDC_AUDIENCES', []))
+else:
+    _TRUSTED_AUDIENCES = frozenset()
+
+# Number of seconds a JWKS response is reused before it is requested again
+OIDC_JWKS_CACHE_TTL = getattr(settings, 'OIDC_JWKS_CACHE_TTL', 10 * 60) # 10 minutes
+
+# Minimum number of seconds between requesting the JWKS again because a token's
+# key id was not found in the cached copy
+OIDC_JWKS_MIN_REFRESH_INTERVAL = getattr(settings, 'OIDC_JWKS_MIN_REFRESH_INTERVAL', 30)
+
+# Maps JWKS endpoint -> (expiration time, fetch time, jwks, {kid: jwk})
+# NOTE: Entries are immutable tuples, so they can be read without the lock.
+#       The lock is only held while requesting the JWKS from the OP.
+_JWKS_CACHE = {}
+_JWKS_CACHE_LOCK = threading.Lock()
+
+
+def _cached_jwks(endpoint, stale=None):
+    """Get the cached JWKS for the endpoint, if it can still be used
+
+    Args:
+        endpoint (str): JWKS endpoint of the OP
+        stale (dict): JWKS that didn't contain the requested key
+
+    Returns:
+        tuple(dict, dict): JWKS of the OP and its keys indexed by key id
+        None: If the JWKS needs to be requested from the OP
+    """
+    entry = _JWKS_CACHE.get(endpoint)
+    if entry is None:
+        return None
+
+    expiration, fetched, jwks, kid_index = entry
+    now = time.monotonic()
+    if now >= expiration:
+        return None
+    if jwks is stale and now - fetched >= OIDC_JWKS_MIN_REFRESH_INTERVAL:
+        return None
+    return jwks, kid_index
+
+
+# (connect, read) timeouts in seconds for requests to the OP
+OIDC_HTTP_TIMEOUT = (3, 5)
+
+# Shared session, so connections to the OP are kept alive and reused
+_HTTP = requests.Session()
+for _prefix in ('https://', 'http://'):
+    _HTTP.mount(_prefix, HTTPAdapter(pool_connections=4,
+                                     pool_maxsize=16,
+                                     max_retries=Retry(total=2, backoff_factor=0.2)))
+
+# Number of seconds to remember that a user was synced from a token, so later
+# requests with the same token skip the sync and only load the user
+# Set to 0 to always sync the user (disables both the cache and the
+# Keycloak.last_synced_iat check)
+OIDC_USER_SYNC_CACHE_TTL = getattr(settings, 'OIDC_USER_SYNC_CACHE_TTL', 5 * 60) # 5 minutes
+OIDC_USER_SYNC_CACHE_SIZE = 10000
+
+# Maps (uid, iat, roles) -> (expiration time, user pk)
+# NOTE: Only the pk is cached, as model instances must not be shared between
+#       requests or threads
+_USER_SYNC_CACHE = {}
+_USER_SYNC_CACHE_LOCK = threading.Lock()
+
+
+def _get_synced_user_pk(key):
+    """Get the pk of a user that was already synced for the given key
+
+    Args:
+        key (tuple): (uid, iat, roles) of the token the user was synced from
+
+    Returns:
+        object: The pk of the synced user
+        None: If the user was not synced or the entry expired
+    """
+    with _USER_SYNC_CACHE_LOCK:
+        expiration, pk = _USER_SYNC_CACHE.get(key, (0, None))
+        if pk is not None and time.monotonic() >= expiration:
+            del _USER_SYNC_CACHE[key]
+            pk = None
+        return pk
+
+
+def _set_synced_user_pk(key, pk):
+    """Remember the pk of a user that was synced for the given key
+
+    Args:
+        key (tuple): (uid, iat, roles) of the token the user was synced from
+        pk (object): The pk of the synced user
+    """
+    with _USER_SYNC_CACHE_LOCK:
+        now = time.monotonic()
+        if len(_USER_SYNC_CACHE) >= OIDC_USER_SYNC_CACHE_SIZE:
+            for k in [k for k, (exp, _) in _USER_SYNC_CACHE.items() if now >= exp]:
+                del _USER_SYNC_CACHE[k]
+            if len(_USER_SYNC_CACHE) >= OIDC_USER_SYNC_CACHE_SIZE:
+                _USER_SYNC_CACHE.clear()
+        _USER_SYNC_CACHE[key] = (now + OIDC_USER_SYNC_CACHE_TTL, pk)
+
 
 def update_user_data(user, userinfo):
     """Default implementation of the UPDATE_USER_DATA callback
@@ -72,6 +182,45 @@ else: # pragma: no cover
     UPDATE_USER_DATA_FUNCTION = import_from_string(UPDATE_USER_DATA, 'UPDATE_USER_DATA')
 
 
+# Userinfo claim -> user model field
+# NOTE: If multiple claims map to the same field the last one present is used
+_USERINFO_FIELDS = (
+    ('first_name', 'first_name'),
+    ('given_name', 'first_name'),
+    ('christian_name', 'first_name'),
+    ('family_name', 'last_name'),
+    ('last_name', 'last_name'),
+    ('email', 'email'),
+)
+_MISSING = object()
+
+# Resolved on first use, as the app registry may not be ready at import time
+_USER_MODEL = None
+_USERNAME_MAX_LENGTH = None
+_USER_FIELDS = None
+
+def _user_model():
+    """Get the cached Django user model"""
+    global _USER_MODEL
+    if _USER_MODEL is None:
+        _USER_MODEL = get_user_model()
+    return _USER_MODEL
+
+def _username_max_length():
+    """Get the cached max length of the user model's username field"""
+    global _USERNAME_MAX_LENGTH
+    if _USERNAME_MAX_LENGTH is None:
+        _USERNAME_MAX_LENGTH = _user_model()._meta.get_field("username").max_length
+    return _USERNAME_MAX_LENGTH
+
+def _user_fields():
+    """Get the cached attribute names of the user model's concrete fields"""
+    global _USER_FIELDS
+    if _USER_FIELDS is None:
+        _USER_FIELDS = tuple(field.attname for field in _user_model()._meta.concrete_fields)
+    return _USER_FIELDS
+
+
 def check_username(username):
     """Ensure that the given username does exceed the current user models field
     length
@@ -82,8 +231,7 @@ def check_username(username):
     Raises:
         AuthenticationFailed: If the username length exceeds the fields max length
     """
-    username_field = get_user_model()._meta.get_field("username")
-    if len(username) > username_field.max_length:
+    if len(username) > _username_max_length():
         raise AuthenticationFailed(_('Username is too long for Django'))
 
 
@@ -130,62 +278,100 @@ def get_user_with_id(access_token, userinfo):
     Raises:
         AuthenticationFailed: If the requesting user's username is too long
     """
-    UserModel = get_user_model()
+    UserModel = _user_model()
     uid = userinfo['sub']
     username = userinfo['preferred_username']
+    roles = get_roles(access_token)
+
+    # A user only has to be synced once per token
+    iat = userinfo.get('iat') or access_token.get('iat')
+    sync_key = (uid, iat, tuple(roles))
+    roles_hash = hashlib.blake2b(json.dumps(roles).encode('utf-8'), digest_size=16).hexdigest()
+    skip_synced = iat is not None and OIDC_USER_SYNC_CACHE_TTL > 0
+    if skip_synced:
+        pk = _get_synced_user_pk(sync_key)
+        if pk is not None:
+            # Load a fresh instance, the user may have been deleted since
+            user = UserModel.objects.filter(pk=pk).first()
+            if user is not None:
+                return user
 
     check_username(username)
 
     # Some OP may actually choose to withhold some information, so we must test if it is present
-    openid_data = {'last_login': datetime.datetime.now()}
-    if 'first_name' in userinfo.keys():
-        openid_data['first_name'] = userinfo['first_name']
-    if 'given_name' in userinfo.keys():
-        openid_data['first_name'] = userinfo['given_name']
-    if 'christian_name' in userinfo.keys():
-        openid_data['first_name'] = userinfo['christian_name']
-    if 'family_name' in userinfo.keys():
-        openid_data['last_name'] = userinfo['family_name']
-    if 'last_name' in userinfo.keys():
-        openid_data['last_name'] = userinfo['last_name']
-    if 'email' in userinfo.keys():
-        openid_data['email'] = userinfo['email']
+    openid_data = {'last_login': timezone.now()}
+    for src, dst in _USERINFO_FIELDS:
+        value = userinfo.get(src, _MISSING)
+        if value is not _MISSING:
+            openid_data[dst] = value
+
+    roles_set = set(roles)
+    is_superuser = 'superuser' in roles_set
+    role_data = {
+        'is_staff': is_superuser or 'admin' in roles_set,
+        'is_superuser': is_superuser,
+    }
 
     # DP NOTE: The thing that we are trying to prevent is the user account being
     #          deleted and recreated in Keycloak (all user data the same, but a
     #          different uid) and getting the application permissions of the old
     #          user account.
 
-    try: # try to lookup by keycloak UID first
-        kc_user = KeycloakModel.objects.get(UID = uid)
-        user = kc_user.user
-    except KeycloakModel.DoesNotExist: # user doesn't exist with a keycloak UID
-        try:
-            user = UserModel.objects.get_by_natural_key(username)
-
-            fmt = "Deleting user '{}' because it matches the authenticated Keycloak username"
-            _log('get_user_by_id').info(fmt.format(username))
-
-            # remove existing user account, so permissions are not transfered
-            # DP NOTE: required, as the username field is still a unique field,
-            #          which doesn't allow multiple users in the table with the
-            #          same username
-            user.delete()
-        except UserModel.DoesNotExist:
-            pass
-
-        args = {UserModel.USERNAME_FIELD: username, 'defaults': openid_data, }
-        user, created = UserModel.objects.update_or_create(**args)
-        kc_user = KeycloakModel.objects.create(user = user, UID = uid)
-
-    roles = get_roles(access_token)
-    user.is_staff = 'admin' in roles or 'superuser' in roles
-    user.is_superuser = 'superuser' in roles
-
-    LOAD_USER_ROLES_FUNCTION(user, roles)
-    UPDATE_USER_DATA_FUNCTION(user, userinfo)
-
-    user.save()
+    # Coalesce all of the writes for the login into a single commit
+    with transaction.atomic():
+        try: # try to lookup by keycloak UID first
+            kc_user = KeycloakModel.objects.select_related('user').get(UID = uid)
+            user = kc_user.user
+
+            if (skip_synced and
+                kc_user.last_synced_iat == iat and
+                kc_user.last_synced_roles == roles_hash):
+                _set_synced_user_pk(sync_key, user.pk)
+                return user
+        except KeycloakModel.DoesNotExist: # user doesn't exist with a keycloak UID
+            try:
+                user = UserModel.objects.get_by_natural_key(username)
+
+                fmt = "Deleting user '{}' because it matches the authenticated Keycloak username"
+                _log('get_user_by_id').info(fmt.format(username))
+
+                # remove existing user account, so permissions are not transfered
+                # DP NOTE: required, as the username field is still a unique field,
+                #          which doesn't allow multiple users in the table with the
+                #          same username
+                user.delete()
+            except UserModel.DoesNotExist:
+                pass
+
+            openid_data.update(role_data)
+            args = {UserModel.USERNAME_FIELD: username, 'defaults': openid_data, }
+            user, created = UserModel.objects.update_or_create(**args)
+            kc_user = KeycloakModel.objects.create(user = user, UID = uid,
+                                                   last_synced_iat = iat,
+                                                   last_synced_roles = roles_hash)
+
+        # Only write the columns that changed, either from the user's roles or
+        # from the callbacks, so an unchanged user doesn't cause an UPDATE
+        fields = _user_fields()
+        original = {name: getattr(user, name) for name in fields}
+
+        for name, value in role_data.items():
+            setattr(user, name, value)
+
+        LOAD_USER_ROLES_FUNCTION(user, roles)
+        UPDATE_USER_DATA_FUNCTION(user, userinfo)
+
+        changed = [name for name in fields if getattr(user, name) != original[name]]
+        if changed:
+            user.save(update_fields=changed)
+
+        if kc_user.last_synced_iat != iat or kc_user.last_synced_roles != roles_hash:
+            kc_user.last_synced_iat = iat
+            kc_user.last_synced_roles = roles_hash
+            kc_user.save(update_fields=['last_synced_iat', 'last_synced_roles'])
+
+    if skip_synced:
+        _set_synced_user_pk(sync_key, user.pk)
     return user
 
 
@@ -201,27 +387,27 @@ def get_roles(decoded_token):
         list[str]: List of role names
     """
 
+    resource_access = decoded_token.get('resource_access', {})
+
     # Extract realm scoped roles
     try:
         # Session logins and Bearer tokens from password Grant Types
         if 'realm_access' in decoded_token:
-            roles = decoded_token['realm_access']['roles']
+            roles = list(decoded_token['realm_access']['roles'])
         else: #  Bearer tokens from authorization_code Grant Types
               # DP ???: a session login uses an authorization_code code, not sure
               #         about the difference
-            roles = decoded_token['resource_access']['account']['roles']
+            roles = list(resource_access['account']['roles'])
     except KeyError:
         roles = []
 
     # Extract all client scoped roles
-    for name, client in decoded_token.get('resource_access', {}).items():
-        if name is 'account':
+    # NOTE: roles is always a copy, as the decoded token is cached and shared
+    #       and the list is passed to the LOAD_USER_ROLES callback
+    for name, client in resource_access.items():
+        if name == 'account':
             continue
-
-        try:
-            roles.extend(client['roles'])
-        except KeyError: # pragma no cover
-            pass
+        roles.extend(client.get('roles', ()))
 
     return roles
 
@@ -232,15 +418,49 @@ def get_access_token(request):
     The access token is searched first the request's session. If it is not
     found it is then searched in the request's ``Authorization`` header.
 
+    The decoded payload is stored on the request, so looking up the access
+    token again for the same request doesn't decode it a second time.
+
     Args:
         request (Request): Django request from the user
 
     Returns:
         dict: JWT payload of the bearer token
+
+    Raises:
+        AuthenticationFailed: If there is no token in the ``Authorization`` header
     """
     access_token = request.session.get("access_token")
     if access_token is None:  # Bearer token login
-        access_token = get_authorization_header(request).split()[1]
+        auth = request.META.get('HTTP_AUTHORIZATION', b'')
+        if isinstance(auth, str):
+            # Work around django test client oddness
+            auth = auth.encode('iso-8859-1')
+        sep = auth.find(b' ')
+        access_token = auth[sep + 1:].strip() if sep > 0 else b''
+        if not access_token:
+            raise AuthenticationFailed(_('Invalid Authorization header. No credentials provided.'))
+
+    if getattr(request, '_oidc_access_token_raw', None) != access_token:
+        request._oidc_access_token_payload = decode_access_token(access_token)
+        request._oidc_access_token_raw = access_token
+    return request._oidc_access_token_payload
+
+
+@functools.lru_cache(maxsize=1024)
+def decode_access_token(access_token):
+    """Decode the payload of the given access token
+
+    Note: Decoded payloads are cached, so the same token is only decoded once.
+          The returned dictionary is shared and should not be modified.
+
+    Args:
+        access_token (str|bytes): The user's encoded bearer token
+
+    Returns:
+        dict: JWT payload of the bearer token
+    """
+    from jwkest.jwt import JWT
     return JWT().unpack(access_token).payload()
 
 
@@ -254,36 +474,26 @@ def get_token_audience(token):
         token (dict): The user's decoded bearer token
 
     Returns:
-        list[str]: The list of token audiences
+        tuple[str]|list[str]: The token audiences
     """
 
-    aud = token.get("aud", [])
-    return [aud] if isinstance(aud, str) else aud
+    aud = token.get("aud")
+    if aud is None:
+        return ()
+    return (aud,) if isinstance(aud, str) else aud
 
 
 def token_audience_is_valid(audience):
     """Check if the input audiences is valid
 
     Args:
-        audience (list[str]): List of token audiences
+        audience (iterable[str]): Token audiences
 
     Returns:
         bool: If any of the audience is in the list of requested audiences
     """
 
-    if not hasattr(settings, 'OIDC_AUTH'):
-        # Don't assume that the bossoidc settings module was used
-        return False
-
-    trusted_audiences = settings.OIDC_AUTH.get('OIDC_AUDIENCES', [])
-
-    for aud in audience:
-        if aud in trusted_audiences:
-            result = True
-            break
-    else:
-        result = False
-    return result
+    return not _TRUSTED_AUDIENCES.isdisjoint(audience)
 
 
 class OpenIdConnectBackend(OIDCAuthenticationBackend): # pragma: no cover
@@ -307,32 +517,83 @@ class OpenIdConnectBackend(OIDCAuthenticationBackend): # pragma: no cover
         Raises:
             (SuspiciousOperation)
         """
-        response_jwks = requests.get(
-            self.OIDC_OP_JWKS_ENDPOINT,
-            verify=self.get_settings('OIDC_VERIFY_SSL', True)
-        )
-        response_jwks.raise_for_status()
-        jwks = response_jwks.json()
-
         # Compute the current header from the given token to find a match
-        jws = JWS.from_compact(token)
-        json_header = jws.signature.protected
+        # Only the header is needed, so skip decoding the payload and signature
+        json_header = b64decode(force_bytes(token).split(b'.', 1)[0])
         header = Header.json_loads(json_header)
 
-        key = None
-        num_keys = len(jwks['keys'])
-        for jwk in jwks['keys']:
-            # If there's only one key, then try it even if the key id doesn't
-            # match or is None.
-            if jwk['kid'] != smart_text(header.kid) and num_keys > 1:
-                continue
-            if 'alg' in jwk and jwk['alg'] != smart_text(header.alg):
-                raise SuspiciousOperation('alg values do not match.')
-            key = jwk
+        jwks, kid_index = self.get_jwks()
+        key = self.find_matching_jwk(jwks, kid_index, header)
+        if key is None:
+            # The OP may have rotated its keys since the JWKS was cached
+            jwks, kid_index = self.get_jwks(stale=jwks)
+            key = self.find_matching_jwk(jwks, kid_index, header)
         if key is None:
             raise SuspiciousOperation('Could not find a valid JWKS.')
         return key
 
+    def get_jwks(self, stale=None):
+        """Get the JWKS of the OP, using the cached copy if it has not expired
+
+        Args:
+            stale (dict): JWKS that didn't contain the requested key. If it is
+                          still the cached copy it is requested again from
+                          the OP, even if it has not expired, unless it was
+                          requested less than OIDC_JWKS_MIN_REFRESH_INTERVAL
+                          seconds ago.
+
+        Returns:
+            tuple(dict, dict): JWKS of the OP and its keys indexed by key id
+        """
+        endpoint = self.OIDC_OP_JWKS_ENDPOINT
+        cached = _cached_jwks(endpoint, stale)
+        if cached is not None:
+            return cached
+
+        with _JWKS_CACHE_LOCK:
+            # Another thread may have refreshed the JWKS while waiting for the lock
+            cached = _cached_jwks(endpoint, stale)
+            if cached is not None:
+                return cached
+
+            response_jwks = _HTTP.get(
+                endpoint,
+                verify=self.get_settings('OIDC_VERIFY_SSL', True),
+                timeout=OIDC_HTTP_TIMEOUT
+            )
+            response_jwks.raise_for_status()
+            jwks = response_jwks.json()
+            kid_index = {jwk['kid']: jwk for jwk in jwks['keys'] if 'kid' in jwk}
+
+            now = time.monotonic()
+            _JWKS_CACHE[endpoint] = (now + OIDC_JWKS_CACHE_TTL, now, jwks, kid_index)
+            return jwks, kid_index
+
+    def find_matching_jwk(self, jwks, kid_index, header):
+        """Find the key in the JWKS used to sign a token
+
+        Args:
+            jwks (dict): JWKS of the OP
+            kid_index (dict): JWKS keys indexed by key id
+            header (Header): The token's JWS header
+
+        Returns:
+            dict: The matching key
+            None: If no key matches the header
+
+        Raises:
+            (SuspiciousOperation): If the key's alg doesn't match the header
+        """
+        alg = str(header.alg)
+        key = kid_index.get(str(header.kid))
+        if key is None and len(jwks['keys']) == 1:
+            # If there's only one key, then try it even if the key id doesn't
+            # match or is None.
+            key = jwks['keys'][0]
+        if key is not None and 'alg' in key and key['alg'] != alg:
+            raise SuspiciousOperation('alg values do not match.')
+        return key
+
     def verify_claims(self, claims):
         """Ensure required claims provided.
 
@@ -378,6 +639,6 @@ class OpenIdConnectBackend(OIDCAuthenticationBackend): # pragma: no cover
             msg = 'Claims verification failed'
             raise SuspiciousOperation(msg)
 
-        decoded_token = JWT().unpack(access_token).payload()
+        decoded_token = decode_access_token(access_token)
         user = get_user_with_id(decoded_token, user_info)
         return user
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-15 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bossoidc2', '0002_auto_20201110_2129'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keycloak',
+            name='last_synced_iat',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-15 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bossoidc2', '0003_keycloak_last_synced_iat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keycloak',
+            name='last_synced_roles',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
@@ -18,6 +18,10 @@ from django.db import models
 class Keycloak(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     UID = models.CharField(max_length=37, primary_key=True)
+    # Issued at time of the last token the user was synced from
+    last_synced_iat = models.BigIntegerField(null=True, blank=True)
+    # Hash of the roles in the last token the user was synced from
+    last_synced_roles = models.CharField(max_length=32, null=True, blank=True)
 
     class Meta:
 
@@ -26,7 +26,7 @@ def read(filename):
 if __name__ == '__main__':
     setup(
         name='boss-oidc2',
-        version='2.0.1',
+        version='2.1.0',
         packages=find_packages(),
         url='https://github.com/jhuapl-boss/boss-oidc2',
         license="Apache Software License",